@@ -1,158 +1,228 @@
+import argparse
 import asyncio
-import json
 import os
 import datetime
-from bech32 import bech32_decode, convertbits
-import websockets
+import time
+from nostrjson import json_dumps, json_loads
+from relaycache import wait_for_refreshes
+from relayclient import fetch_events_by_relay, fetch_relay_list, merge_relay_events
+from relaypool import RelayPool
 from conkey import decode_npub
 
-# Popular relays used to fetch the user's relay list (NIP-65)
-POPULAR_RELAYS = [
-    "wss://eu.purplerelay.com",
-    "wss://nos.lol",
-    "wss://nosdrive.app/relay",
-    "wss://nostrelites.org",
-    "wss://relay.damus.io",
-    "wss://relay.nostr.band",
-    "wss://relay.primal.net",
-    "wss://relay.snort.social",
-    "wss://vitor.nostr1.com",
-]
-
-
-async def fetch_relay_list(pubkey: str) -> dict:
+
+def backup_folder_path() -> str:
     """
-    Fetches the user's relay list (NIP-65) from popular relays and returns read and write relay lists.
+    Returns the backup folder, creating it if needed.
     """
-    for relay_url in POPULAR_RELAYS:
-        try:
-            async with websockets.connect(relay_url) as websocket:
-                sub_id = os.urandom(4).hex()
-                # Request relay list event (kind=10002)
-                request = json.dumps([
-                    "REQ", sub_id, {"kinds": [10002], "authors": [pubkey]}
-                ])
-                await websocket.send(request)
-
-                relay_list = {"read": [], "write": []}
-                while True:
-                    try:
-                        response = await asyncio.wait_for(websocket.recv(), timeout=10)
-                    except asyncio.TimeoutError:
-                        # Stop waiting after timeout
-                        break
-
-                    message = json.loads(response)
-
-                    if message[0] == "EVENT" and message[1] == sub_id:
-                        event = message[2]
-                        if event.get("kind") == 10002:
-                            for tag in event.get("tags", []):
-                                if tag[0] == "r" and len(tag) > 1:
-                                    uri = tag[1]
-                                    role = tag[2] if len(tag) > 2 else None
-                                    if role == "read":
-                                        relay_list["read"].append(uri)
-                                    elif role == "write":
-                                        relay_list["write"].append(uri)
-                                    else:
-                                        relay_list["read"].append(uri)
-                                        relay_list["write"].append(uri)
-                    elif message[0] == "EOSE" and message[1] == sub_id:
-                        break
-
-                if relay_list["read"] or relay_list["write"]:
-                    return relay_list
-
-        except Exception as e:
-            print(f"Unable to connect to relay {relay_url}: {e}")
-
-    # If no relay provides a relay list, return default relays.
-    print("Failed to fetch NIP-65 relay list from any relay. Using default relays.")
-    return {"read": POPULAR_RELAYS, "write": POPULAR_RELAYS}
-
-async def fetch_all_events(relays: list, pubkey: str) -> list:
+    backup_folder = os.path.join(os.getcwd(), "backup")
+    if not os.path.exists(backup_folder):
+        os.makedirs(backup_folder)
+    return backup_folder
+
+def load_backup_meta(pubkey: str) -> dict:
     """
-    Fetches all historical events for the given public key from the provided relays.
+    Loads the incremental backup state for the user, or an empty dict if there is none.
     """
-    events = []
-    for relay_url in relays:
-        try:
-            async with websockets.connect(relay_url) as websocket:
-                sub_id = os.urandom(4).hex()
-                # Request events (kinds 0 to 40000)
-                request = json.dumps([
-                    "REQ", sub_id, {"kinds": list(range(0, 40000)), "authors": [pubkey]}
-                ])
-                await websocket.send(request)
-
-                while True:
-                    try:
-                        response = await asyncio.wait_for(websocket.recv(), timeout=10)
-                    except asyncio.TimeoutError:
-                        break
-
-                    message = json.loads(response)
-                    if message[0] == "EVENT" and message[1] == sub_id:
-                        event = message[2]
-                        events.append(event)
-                    elif message[0] == "EOSE" and message[1] == sub_id:
-                        break
-
-        except Exception as e:
-            print(f"Unable to connect to relay {relay_url}: {e}")
-
-    return events
-
-def save_events_to_backup(pubkey: str, events: list):
+    meta_path = os.path.join(backup_folder_path(), f"{pubkey[:8]}_meta.json")
+    try:
+        with open(meta_path, "rb") as f:
+            meta = json_loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    return meta if isinstance(meta, dict) else {}
+
+def save_backup_meta(pubkey: str, meta: dict):
     """
-    Saves the fetched events into a JSON file in a backup folder.
+    Saves the incremental backup state for the user next to the backups.
     """
-    backup_folder = os.path.join(os.getcwd(), "backup")
-    if not os.path.exists(backup_folder):
-        os.makedirs(backup_folder)
+    meta_path = os.path.join(backup_folder_path(), f"{pubkey[:8]}_meta.json")
+    try:
+        with open(meta_path, "w", encoding="utf-8") as f:
+            f.write(json_dumps(meta))
+    except Exception as e:
+        print(f"Failed to save backup state: {e}")
 
+def relay_cursor_for(events: list, cursor: dict | None) -> dict | None:
+    """
+    Moves a relay's cursor past `events`, everything the relay sent from its previous cursor
+    up to EOSE. The cursor is {"since": timestamp, "last_ids": ids saved at or after it}.
+    """
+    # Events without a usable timestamp can't place the cursor
+    timestamps = [
+        event["created_at"] for event in events
+        if isinstance(event.get("created_at"), int) and not isinstance(event["created_at"], bool)
+    ]
+    if not timestamps:
+        return cursor
+    # An event dated in the future must not push the cursor past events that are still to come
+    last_created_at = min(max(timestamps), int(time.time()))
+    # `since` is inclusive, so remember which events at or after the cursor were already saved
+    last_ids = [
+        event["id"] for event in events
+        if isinstance(event.get("created_at"), int) and event["created_at"] >= last_created_at
+    ]
+    if cursor and last_created_at <= cursor["since"]:
+        return {"since": cursor["since"], "last_ids": list(set(cursor["last_ids"]).union(last_ids))}
+    return {"since": last_created_at, "last_ids": last_ids}
+
+def saved_ids_among(filename: str, ids: set) -> set:
+    """
+    Returns which of `ids` are already saved in an NDJSON backup file.
+    """
+    found = set()
+    with open(os.path.join(backup_folder_path(), filename), "rb") as f:
+        for line in f:
+            # Backups are written compactly, so the id can be sliced out without parsing the line
+            start = line.find(b'"id":"')
+            if start >= 0:
+                start += 6
+                event_id = line[start:line.find(b'"', start)].decode()
+            elif line.strip():
+                event_id = json_loads(line).get("id")
+            else:
+                continue
+            if event_id in ids:
+                found.add(event_id)
+    return found
+
+def save_events_to_backup(pubkey: str, events: list) -> str | None:
+    """
+    Saves the fetched events into an NDJSON file (one event per line) in a backup folder
+    and returns the file name.
+    """
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{pubkey[:8]}_{timestamp}_backup.json"
-    filepath = os.path.join(backup_folder, filename)
+    filename = f"{pubkey[:8]}_{timestamp}_backup.jsonl"
+    filepath = os.path.join(backup_folder_path(), filename)
 
     try:
+        # Write one event at a time instead of encoding them all as a whole
         with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(events, f, ensure_ascii=False, indent=4)
+            for event in events:
+                f.write(json_dumps(event))
+                f.write("\n")
         print(f"Events successfully saved to {filepath}")
+        return filename
     except Exception as e:
         print(f"Failed to save events: {e}")
+        return None
 
-async def main():
+def append_events_to_backup(filename: str, events: list) -> bool:
+    """
+    Appends new events to an existing NDJSON backup file.
+    """
+    filepath = os.path.join(backup_folder_path(), filename)
     try:
-        npub_input = input("Please enter the user's npub key: ").strip()
-        if not npub_input:
-            print("Invalid npub key.")
-            return
-
-        # Decoding npub (using ./conkey.py)
-        pubkey = decode_npub(npub_input)
-        print(f"Decoded Public Key: {pubkey}")
-
-        # Fetch the user's relay list (NIP-65)
-        print("Fetching relay list...")
-        relay_list = await fetch_relay_list(pubkey)
-        read_relays = relay_list.get("read", [])
-        print(f"User's Read Relays: {read_relays}")
-
-        # Fetch events from the user's relays
-        print("Fetching events from relays...")
-        events = await fetch_all_events(read_relays, pubkey)
-        print(f"Total {len(events)} events fetched.")
-
-        if events:
-            # Save the events to a backup file
-            save_events_to_backup(pubkey, events)
-        else:
-            print("No events found to backup.")
+        with open(filepath, "a", encoding="utf-8") as f:
+            for event in events:
+                f.write(json_dumps(event))
+                f.write("\n")
+        print(f"Events successfully appended to {filepath}")
+        return True
+    except Exception as e:
+        print(f"Failed to append events: {e}")
+        return False
+
+async def main(use_cache: bool = True, full: bool = False):
+    try:
+        async with RelayPool() as pool:
+            npub_input = input("Please enter the user's npub key: ").strip()
+            if not npub_input:
+                print("Invalid npub key.")
+                return
+
+            # Decoding npub (using ./conkey.py)
+            pubkey = decode_npub(npub_input)
+            print(f"Decoded Public Key: {pubkey}")
+
+            # Fetch the user's relay list (NIP-65)
+            print("Fetching relay list...")
+            relay_list = await fetch_relay_list(pool, pubkey, use_cache)
+            read_relays = relay_list.get("read", [])
+            print(f"User's Read Relays: {read_relays}")
+
+            # Continue from the last backup if it is still there, otherwise start a full one
+            meta = {} if full else load_backup_meta(pubkey)
+            backup_file = meta.get("backup_file")
+            # Older JSON array backups can't be appended to; those start a new NDJSON backup
+            if (
+                not backup_file
+                or not backup_file.endswith(".jsonl")
+                or not os.path.exists(os.path.join(backup_folder_path(), backup_file))
+            ):
+                meta = {}
+                backup_file = None
+            # Each relay has its own cursor, so one unreachable relay doesn't hold back the others
+            cursors = meta.get("relays")
+            if not isinstance(cursors, dict):
+                cursors = {}
+            since_by_relay = {relay_url: cursor["since"] for relay_url, cursor in cursors.items()}
+
+            # Fetch events from the user's relays
+            if backup_file is None:
+                print("Fetching events from relays...")
+            else:
+                print(f"Fetching events since the last backup ({backup_file})...")
+            events_by_relay = await fetch_events_by_relay(pool, read_relays, pubkey, since_by_relay)
+            incomplete_relays = [relay_url for relay_url, (_, complete) in events_by_relay.items() if not complete]
+            if incomplete_relays:
+                print(f"Relays that did not finish sending events: {incomplete_relays}")
+            fetched = merge_relay_events(events_by_relay)
+
+            events = fetched
+            if backup_file is not None:
+                known_ids = set()
+                for cursor in cursors.values():
+                    known_ids.update(cursor["last_ids"])
+                events = [event for event in fetched if event["id"] not in known_ids]
+                # Relays whose cursor is behind, or that stopped early last time, send again events
+                # that are already saved; look those up in the backup itself
+                if events:
+                    saved_ids = saved_ids_among(backup_file, {event["id"] for event in events})
+                    events = [event for event in events if event["id"] not in saved_ids]
+            print(f"Total {len(events)} events fetched.")
+
+            if backup_file is None:
+                if not events:
+                    print("No events found to backup.")
+                    return
+                # Save the events to a new backup file
+                backup_file = save_events_to_backup(pubkey, events)
+                if not backup_file:
+                    return
+            elif not events:
+                print("No new events found to backup.")
+            elif not append_events_to_backup(backup_file, events):
+                return
+
+            # Relays that finished move their cursor forward; unfinished ones keep theirs and
+            # are asked again from there next time
+            new_cursors = {}
+            for relay_url, (relay_events, complete) in events_by_relay.items():
+                cursor = cursors.get(relay_url)
+                if complete:
+                    cursor = relay_cursor_for(relay_events, cursor)
+                if cursor is not None:
+                    new_cursors[relay_url] = cursor
+            save_backup_meta(pubkey, {"backup_file": backup_file, "relays": new_cursors})
 
     except Exception as e:
         print(f"An error occurred: {e}")
+    finally:
+        # Let a background relay list refresh finish writing the cache
+        await wait_for_refreshes()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--no-cache", action="store_true", help="ignore the cached relay list and fetch it again")
+    parser.add_argument("--full", action="store_true", help="fetch every event instead of only those since the last backup")
+    args = parser.parse_args()
+
+    # uvloop is optional; without it the default event loop is used
+    try:
+        import uvloop
+        loop_factory = uvloop.new_event_loop
+    except ImportError:
+        loop_factory = None
+
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        runner.run(main(use_cache=not args.no_cache, full=args.full))
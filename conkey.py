@@ -1,14 +1,52 @@
-from bech32 import bech32_decode, bech32_encode, convertbits
+from functools import lru_cache
+
+from bech32 import bech32_decode, bech32_encode
+
+# Maps 5-bit values to base-32 digits for int(); anything else maps to an invalid digit
+_BASE32_DIGITS = bytes.maketrans(
+    bytes(range(32)) + bytes(range(32, 256)),
+    b"0123456789abcdefghijklmnopqrstuv" + b"!" * 224,
+)
+
+# Repack 5-bit groups into bytes (convertbits(data, 5, 8, False)) using int arithmetic
+def five_bit_to_bytes(data: list) -> bytes | None:
+    if not data:
+        return b""
+    try:
+        value = int(bytes(data).translate(_BASE32_DIGITS), 32)
+    except ValueError:
+        return None
+    pad_bits = len(data) * 5 % 8
+    # Leftover bits must be less than a full group and all zero
+    if pad_bits >= 5 or value & ((1 << pad_bits) - 1):
+        return None
+    return (value >> pad_bits).to_bytes(len(data) * 5 // 8, "big")
+
+# Split bytes into 5-bit groups, zero-padding the last one (convertbits(data, 8, 5, True))
+def bytes_to_five_bit(data: bytes) -> list:
+    count = (len(data) * 8 + 4) // 5
+    value = int.from_bytes(data, "big") << (count * 5 - len(data) * 8)
+    return [(value >> shift) & 31 for shift in range((count - 1) * 5, -1, -5)]
 
 # Decode a simple bech32 format (npub, nsec, note) into hex
+# Results are cached since the same keys are decoded repeatedly within a run
+@lru_cache(maxsize=4096)
 def decode_basic_bech32(value: str, expected_prefix: str) -> str:
     hrp, data = bech32_decode(value)
     if hrp != expected_prefix:
         raise ValueError(f"Invalid {expected_prefix} format.")
-    decoded = convertbits(data, 5, 8, False)
+    decoded = five_bit_to_bytes(data)
     if decoded is None:
         raise ValueError(f"Invalid {expected_prefix} data.")
-    return bytes(decoded).hex()
+    return decoded.hex()
+
+# Decode an npub into a hex public key
+def decode_npub(npub: str) -> str:
+    return decode_basic_bech32(npub, "npub")
+
+# Decode an nsec into a hex private key
+def decode_nsec(nsec: str) -> str:
+    return decode_basic_bech32(nsec, "nsec")
 
 # Encode a hex string into npub, nsec or note
 def encode_basic_bech32(hexstr: str, prefix: str) -> str:
@@ -16,7 +54,7 @@ def encode_basic_bech32(hexstr: str, prefix: str) -> str:
         key_bytes = bytes.fromhex(hexstr)
     except ValueError:
         raise ValueError("Invalid hex string.")
-    data = convertbits(list(key_bytes), 8, 5, True)
+    data = bytes_to_five_bit(key_bytes)
     return bech32_encode(prefix, data)
 
 # Decode TLV and return a dict of all found fields
@@ -24,7 +62,7 @@ def decode_tlv_bech32_full(value: str, expected_prefix: str) -> dict:
     hrp, data = bech32_decode(value)
     if hrp != expected_prefix:
         raise ValueError(f"Invalid {expected_prefix} format.")
-    decoded = convertbits(data, 5, 8, False)
+    decoded = five_bit_to_bytes(data)
     if decoded is None:
         raise ValueError("Invalid TLV data.")
 
@@ -42,15 +80,15 @@ def decode_tlv_bech32_full(value: str, expected_prefix: str) -> dict:
         v = decoded[i + 2:i + 2 + l]
 
         if t == 0:
-            result["type_0_main"] = bytes(v).hex()
+            result["type_0_main"] = v.hex()
         elif t == 1:
             try:
-                relay = bytes(v).decode("utf-8")
+                relay = v.decode("utf-8")
                 result["relays"].append(relay)
             except UnicodeDecodeError:
                 result["relays"].append("<invalid ascii>")
         elif t == 2:
-            result["author"] = bytes(v).hex()
+            result["author"] = v.hex()
         elif t == 3:
             if l == 4:
                 kind = int.from_bytes(v, byteorder="big")
@@ -72,9 +110,9 @@ def main():
     user_input = input("Enter a bech32 string or 64-char hex key: ").strip()
 
     if user_input.startswith("npub"):
-        print("→ Decoded Public Key (hex):", decode_basic_bech32(user_input, "npub"))
+        print("→ Decoded Public Key (hex):", decode_npub(user_input))
     elif user_input.startswith("nsec"):
-        print("→ Decoded Private Key (hex):", decode_basic_bech32(user_input, "nsec"))
+        print("→ Decoded Private Key (hex):", decode_nsec(user_input))
     elif user_input.startswith("note"):
         print("→ Decoded Note ID (hex):", decode_basic_bech32(user_input, "note"))
     elif user_input.startswith("nprofile"):
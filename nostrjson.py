@@ -0,0 +1,15 @@
+import json
+
+# orjson is optional; fall back to the standard library when it isn't installed
+try:
+    import orjson
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    json_loads = json.loads
@@ -0,0 +1,69 @@
+import asyncio
+import os
+import time
+from nostrjson import json_dumps, json_loads
+
+# Cached relay lists younger than this are used as-is
+RELAY_CACHE_FRESH = 10 * 60
+# Older ones are still used, but refreshed in the background; past this age they are ignored
+RELAY_CACHE_MAX_AGE = 3 * 24 * 60 * 60
+
+# Keeps background refresh tasks referenced until they finish
+_refresh_tasks = set()
+
+
+def relay_cache_path(pubkey: str) -> str:
+    """
+    Returns the cache file path for the user's relay list.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "nostrstart", "relays", f"{pubkey}.json")
+
+
+def load_cached_relay_list(pubkey: str):
+    """
+    Returns (relay_list, age in seconds) from the cache, or (None, None) if there is no usable entry.
+    """
+    path = relay_cache_path(pubkey)
+    try:
+        age = time.time() - os.path.getmtime(path)
+        with open(path, "rb") as f:
+            relay_list = json_loads(f.read())
+    except (OSError, ValueError):
+        return None, None
+
+    if not isinstance(relay_list, dict) or not (relay_list.get("read") or relay_list.get("write")):
+        return None, None
+    return relay_list, age
+
+
+def save_cached_relay_list(pubkey: str, relay_list: dict):
+    """
+    Writes the user's relay list to the cache, replacing any previous entry atomically.
+    """
+    path = relay_cache_path(pubkey)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json_dumps({"read": relay_list["read"], "write": relay_list["write"]}))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Failed to cache relay list: {e}")
+
+
+def refresh_in_background(coro):
+    """
+    Runs a cache refresh coroutine without waiting for it.
+    """
+    task = asyncio.create_task(coro)
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+
+async def wait_for_refreshes():
+    """
+    Waits for pending background refreshes so their results reach the cache before exit.
+    """
+    if _refresh_tasks:
+        await asyncio.gather(*_refresh_tasks, return_exceptions=True)
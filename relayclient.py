@@ -0,0 +1,433 @@
+import asyncio
+import os
+from urllib.parse import urlsplit
+from nostrjson import json_dumps, json_loads
+from relaycache import (
+    RELAY_CACHE_FRESH,
+    RELAY_CACHE_MAX_AGE,
+    load_cached_relay_list,
+    refresh_in_background,
+    save_cached_relay_list,
+)
+from relaypool import RelayPool
+
+# Event kinds worth backing up and re-broadcasting: profile, notes, follows, DMs, deletions,
+# reposts, reactions, public chat, reports, zaps, and the replaceable/addressable ranges.
+# Encoded to JSON once for all REQ filters.
+BACKUP_KINDS = (
+    [0, 1, 3, 4, 5, 6, 7, 40, 41, 42, 1984, 9734, 9735]
+    + list(range(10000, 10100))
+    + list(range(30000, 30100))
+)
+_BACKUP_KINDS_JSON = json_dumps(BACKUP_KINDS)
+
+def valid_relay_urls(urls: list) -> tuple:
+    """
+    Drops duplicate and malformed relay URLs while keeping the original order.
+    """
+    valid = []
+    for url in dict.fromkeys(urls):
+        parts = urlsplit(url)
+        if parts.scheme in ("ws", "wss") and parts.netloc:
+            valid.append(url)
+    return tuple(valid)
+
+# Popular relays used to fetch the user's relay list (NIP-65)
+POPULAR_RELAYS = valid_relay_urls([
+    "wss://eu.purplerelay.com",
+    "wss://nos.lol",
+    "wss://nosdrive.app/relay",
+    "wss://nostrelites.org",
+    "wss://relay.damus.io",
+    "wss://relay.nostr.band",
+    "wss://relay.primal.net",
+    "wss://relay.snort.social",
+    "wss://vitor.nostr1.com",
+])
+
+# Seconds a relay may go without accepting a frame or answering with OK before publishing gives up
+PUBLISH_IDLE_TIMEOUT = 30
+# Frames buffered per relay while events are being published
+PUBLISH_QUEUE_SIZE = 1024
+
+# NIP-65 "r" tag marker -> (is read relay, is write relay); no marker means both
+_ROLE_TO_LISTS = {"read": (True, False), "write": (False, True)}
+
+def is_subscription_frame(response, sub_id: str) -> bool:
+    """
+    Cheap check on the raw frame for an EVENT or EOSE message of our subscription,
+    so NOTICE/OK/AUTH/etc. frames can be skipped without parsing them.
+    """
+    head = response[:64]
+    if isinstance(head, bytes):
+        head = head.decode("utf-8", "ignore")
+    kind = head[:12]
+    return ('"EVENT"' in kind or '"EOSE"' in kind) and sub_id in head
+
+def is_valid_event(event) -> bool:
+    """
+    Checks that an event sent by a relay is an object with a string id, so that
+    one malformed event can't break merging the events of every relay.
+    """
+    return isinstance(event, dict) and isinstance(event.get("id"), str)
+
+async def close_subscription(pool: RelayPool, relay_url: str, websocket, sub_id: str):
+    """
+    Ends a subscription on a pooled connection. If CLOSE can't be sent the connection is
+    dropped instead, so a later user of the socket never sees the old subscription.
+    """
+    try:
+        await websocket.send(json_dumps(["CLOSE", sub_id]))
+    except (Exception, asyncio.CancelledError):
+        await pool.discard(relay_url)
+        raise
+
+async def probe_relay_list(pool: RelayPool, relay_url: str, pubkey: str) -> dict | None:
+    """
+    Requests the relay list (NIP-65) from a single relay. Returns None if the relay
+    is unreachable or has no relay list for the user.
+    """
+    try:
+        websocket = await pool.get(relay_url)
+        sub_id = os.urandom(4).hex()
+        # Request relay list event (kind=10002)
+        request = json_dumps([
+            "REQ", sub_id, {"kinds": [10002], "authors": [pubkey]}
+        ])
+        try:
+            await websocket.send(request)
+
+            relay_list = {"read": [], "write": []}
+            loop = asyncio.get_running_loop()
+            try:
+                # A single idle timer for the subscription, pushed back whenever a frame arrives
+                async with asyncio.timeout(10) as idle:
+                    while True:
+                        response = await websocket.recv()
+                        idle.reschedule(loop.time() + 10)
+
+                        if not is_subscription_frame(response, sub_id):
+                            continue
+
+                        message = json_loads(response)
+
+                        if message[0] == "EVENT" and message[1] == sub_id:
+                            event = message[2]
+                            if event.get("kind") == 10002:
+                                reads_append = relay_list["read"].append
+                                writes_append = relay_list["write"].append
+                                role_flags = _ROLE_TO_LISTS.get
+                                for tag in event.get("tags", []):
+                                    tag_len = len(tag)
+                                    if tag_len > 1 and tag[0] == "r":
+                                        uri = tag[1]
+                                        role = tag[2] if tag_len > 2 else None
+                                        is_read, is_write = role_flags(role, (True, True))
+                                        if is_read:
+                                            reads_append(uri)
+                                        if is_write:
+                                            writes_append(uri)
+                                # Kind 10002 is replaceable, so a single event is the whole relay list
+                                if relay_list["read"] or relay_list["write"]:
+                                    break
+                        elif message[0] == "EOSE" and message[1] == sub_id:
+                            break
+            except TimeoutError:
+                # Stop waiting once the relay has been quiet for 10 seconds
+                pass
+        finally:
+            # The connection stays open in the pool, so end the subscription explicitly,
+            # also when this task is cancelled part way through
+            await close_subscription(pool, relay_url, websocket, sub_id)
+
+        if relay_list["read"] or relay_list["write"]:
+            return relay_list
+
+    except Exception as e:
+        print(f"Unable to connect to relay {relay_url}: {e}")
+        await pool.discard(relay_url)
+
+    return None
+
+async def find_relay_list(pool: RelayPool, pubkey: str) -> dict | None:
+    """
+    Probes the popular relays concurrently and returns the first relay list (NIP-65) found.
+    """
+    tasks = [asyncio.create_task(probe_relay_list(pool, relay_url, pubkey)) for relay_url in POPULAR_RELAYS]
+    try:
+        # Return as soon as any relay answers with a non-empty relay list
+        for next_done in asyncio.as_completed(tasks):
+            relay_list = await next_done
+            if relay_list:
+                return relay_list
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Wait for the cancelled probes to close their subscriptions before the sockets are reused
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return None
+
+async def refresh_relay_list(pubkey: str):
+    """
+    Fetches the relay list again and stores it in the cache.
+    """
+    # Uses its own connections so it never shares a socket with the main flow
+    async with RelayPool() as refresh_pool:
+        relay_list = await find_relay_list(refresh_pool, pubkey)
+    if relay_list:
+        save_cached_relay_list(pubkey, relay_list)
+
+async def fetch_relay_list(pool: RelayPool, pubkey: str, use_cache: bool = True) -> dict:
+    """
+    Fetches the user's relay list (NIP-65) from popular relays and returns read and write relay lists.
+    """
+    if use_cache:
+        cached, age = load_cached_relay_list(pubkey)
+        if cached is not None and age < RELAY_CACHE_FRESH:
+            return cached
+        if cached is not None and age < RELAY_CACHE_MAX_AGE:
+            # Stale-while-revalidate: answer from the cache, update it in the background
+            refresh_in_background(refresh_relay_list(pubkey))
+            return cached
+
+    relay_list = await find_relay_list(pool, pubkey)
+    if relay_list:
+        save_cached_relay_list(pubkey, relay_list)
+        return relay_list
+
+    # If no relay provides a relay list, return default relays.
+    print("Failed to fetch NIP-65 relay list from any relay. Using default relays.")
+    return {"read": list(POPULAR_RELAYS), "write": list(POPULAR_RELAYS)}
+
+async def fetch_events_from_relay(pool: RelayPool, relay_url: str, req_filter: str) -> tuple:
+    """
+    Fetches the events matching an already JSON-encoded filter from a single relay.
+    Returns (events, complete), where complete is True only if the relay sent EOSE.
+    """
+    events = []
+    complete = False
+    skipped = 0
+    events_append = events.append
+    try:
+        websocket = await pool.get(relay_url)
+        sub_id = os.urandom(4).hex()
+        # Only the subscription id differs between relays; the filter is already encoded
+        request = f'["REQ","{sub_id}",{req_filter}]'
+        try:
+            await websocket.send(request)
+
+            # Compactly encoded frames of this subscription start with these exact prefixes
+            event_prefix = f'["EVENT","{sub_id}",'
+            event_start = len(event_prefix)
+            eose_prefix = f'["EOSE","{sub_id}"'
+
+            loop = asyncio.get_running_loop()
+            try:
+                # A single idle timer for the subscription, pushed back whenever a frame arrives
+                async with asyncio.timeout(10) as idle:
+                    while True:
+                        response = await websocket.recv()
+                        idle.reschedule(loop.time() + 10)
+
+                        # Fast path: parse only the event object sliced out of the frame
+                        if isinstance(response, str):
+                            if response.startswith(event_prefix):
+                                event = json_loads(response[event_start:response.rindex("]")])
+                                if is_valid_event(event):
+                                    events_append(event)
+                                else:
+                                    skipped += 1
+                                continue
+                            if response.startswith(eose_prefix):
+                                complete = True
+                                break
+
+                        # Slow path for frames encoded with whitespace, sent as bytes, or unrelated
+                        if not is_subscription_frame(response, sub_id):
+                            continue
+
+                        message = json_loads(response)
+                        if message[0] == "EVENT" and message[1] == sub_id:
+                            event = message[2] if len(message) > 2 else None
+                            if is_valid_event(event):
+                                events_append(event)
+                            else:
+                                skipped += 1
+                        elif message[0] == "EOSE" and message[1] == sub_id:
+                            complete = True
+                            break
+            except TimeoutError:
+                # Stop waiting once the relay has been quiet for 10 seconds
+                pass
+        finally:
+            # The connection stays open in the pool, so end the subscription explicitly,
+            # also when this task is cancelled part way through
+            await close_subscription(pool, relay_url, websocket, sub_id)
+
+    except Exception as e:
+        print(f"Unable to connect to relay {relay_url}: {e}")
+        await pool.discard(relay_url)
+
+    if skipped:
+        print(f"Skipped {skipped} malformed events from relay {relay_url}")
+    return events, complete
+
+async def fetch_events_by_relay(pool: RelayPool, relays: list, pubkey: str, since_by_relay: dict | None = None) -> dict:
+    """
+    Fetches the user's events from each relay separately, starting every relay from its own
+    timestamp in `since_by_relay` (relays without one are asked for everything).
+    Returns {relay_url: (events, complete)}, where complete is True only if the relay sent EOSE.
+    """
+    since_by_relay = since_by_relay or {}
+    # Request events of the backed-up kinds; only `since` differs between relays
+    filter_start = f'{{"kinds":{_BACKUP_KINDS_JSON},"authors":{json_dumps([pubkey])}'
+
+    def req_filter(relay_url: str) -> str:
+        since = since_by_relay.get(relay_url)
+        return filter_start + (f',"since":{int(since)}}}' if since is not None else "}")
+
+    # One task per relay, since tasks for the same relay would share its connection
+    relays = list(dict.fromkeys(relays))
+    # No overall deadline: each relay stops on EOSE or after 10 idle seconds, so a relay
+    # still streaming a long history is never cut off and its events are never dropped
+    results = await asyncio.gather(
+        *(fetch_events_from_relay(pool, relay_url, req_filter(relay_url)) for relay_url in relays),
+        return_exceptions=True,
+    )
+
+    events_by_relay = {}
+    for relay_url, result in zip(relays, results):
+        if isinstance(result, BaseException):
+            print(f"Fetching events from relay {relay_url} failed: {result!r}")
+            result = ([], False)
+        events_by_relay[relay_url] = result
+    return events_by_relay
+
+def merge_relay_events(events_by_relay: dict) -> list:
+    """
+    Merges the events fetched from several relays, keeping one copy per id.
+    """
+    # The same event is usually stored on several relays
+    events_by_id = {}
+    for relay_events, _ in events_by_relay.values():
+        for event in relay_events:
+            events_by_id.setdefault(event["id"], event)
+    return list(events_by_id.values())
+
+async def fetch_all_events(pool: RelayPool, relays: list, pubkey: str, since: int | None = None) -> tuple:
+    """
+    Fetches all historical events for the given public key from the provided relays.
+    If `since` is given, only events created at or after that timestamp are requested.
+    Returns (events, incomplete_relays), listing the relays that failed or never sent EOSE.
+    """
+    events_by_relay = await fetch_events_by_relay(pool, relays, pubkey, dict.fromkeys(relays, since))
+    incomplete_relays = [relay_url for relay_url, (_, complete) in events_by_relay.items() if not complete]
+    return merge_relay_events(events_by_relay), incomplete_relays
+
+async def publish_to_relay(pool: RelayPool, relay_url: str, queue: asyncio.Queue) -> tuple:
+    """
+    Publishes the pre-serialized EVENT frames put on the queue to a single relay, until a None
+    marks the end. Returns (accepted, complete): how many events the relay answered with OK true,
+    and whether every frame was sent and answered.
+    """
+    accepted = 0
+    finished = False
+    try:
+        websocket = await pool.get(relay_url)
+        sent = 0
+        answered = 0
+        progress = asyncio.Event()
+
+        async def read_oks():
+            nonlocal accepted, answered
+            try:
+                while True:
+                    response = await websocket.recv()
+                    # Skip EVENT/NOTICE/etc. frames without parsing them
+                    head = response[:8]
+                    if isinstance(head, bytes):
+                        head = head.decode("utf-8", "ignore")
+                    if '"OK"' not in head:
+                        continue
+                    message = json_loads(response)
+                    if message[0] == "OK" and len(message) > 2:
+                        answered += 1
+                        if message[2] is True:
+                            accepted += 1
+                        progress.set()
+            finally:
+                # Wake the waiter below if the connection goes away
+                progress.set()
+
+        reader = asyncio.create_task(read_oks())
+        try:
+            # Time spent waiting on the queue doesn't count; only a relay that stops
+            # taking frames is given up on, so a slow but steady relay is never cut off
+            while (frame := await queue.get()) is not None:
+                async with asyncio.timeout(PUBLISH_IDLE_TIMEOUT):
+                    await websocket.send(frame)
+                sent += 1
+            finished = True
+
+            # Wait for the remaining OKs for as long as they keep coming
+            while answered < sent:
+                if reader.done():
+                    reader.result()
+                    break
+                progress.clear()
+                async with asyncio.timeout(PUBLISH_IDLE_TIMEOUT):
+                    await progress.wait()
+        finally:
+            reader.cancel()
+            await asyncio.gather(reader, return_exceptions=True)
+        return accepted, True
+    except Exception as e:
+        print(f"Unable to publish to relay {relay_url}: {e!r}")
+        # A relay that failed may have a half-written connection; don't reuse it
+        await pool.discard(relay_url)
+
+    # Keep consuming so that this relay never blocks the reader feeding the others
+    if not finished:
+        while await queue.get() is not None:
+            pass
+    return accepted, False
+
+async def broadcast_events(pool: RelayPool, relays: list, events) -> tuple:
+    """
+    Broadcasts events to all specified relays concurrently, iterating `events` only once.
+    Returns (count, accepted, failed_relays): the number of events read, how many of them
+    each relay accepted, and the relays that failed or stopped answering part way through.
+    """
+    # One task per relay, since tasks for the same relay would share its connection
+    relays = list(dict.fromkeys(relays))
+    # Bounded queues keep memory flat: reading waits for the relays to catch up
+    queues = [asyncio.Queue(maxsize=PUBLISH_QUEUE_SIZE) for _ in relays]
+    tasks = [asyncio.create_task(publish_to_relay(pool, relay, queue)) for relay, queue in zip(relays, queues)]
+
+    count = 0
+    try:
+        for event in events:
+            # Serialize each event once; every relay gets the same frame
+            frame = json_dumps(["EVENT", event])
+            for queue in queues:
+                await queue.put(frame)
+            count += 1
+    finally:
+        for queue in queues:
+            await queue.put(None)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    accepted = {}
+    failed_relays = []
+    for relay_url, result in zip(relays, results):
+        if isinstance(result, BaseException):
+            print(f"Publishing to relay {relay_url} failed: {result!r}")
+            accepted[relay_url] = 0
+            failed_relays.append(relay_url)
+            continue
+        accepted[relay_url], complete = result
+        if not complete:
+            failed_relays.append(relay_url)
+
+    return count, accepted, failed_relays
@@ -0,0 +1,66 @@
+import asyncio
+import websockets
+from websockets.protocol import State
+
+
+class RelayPool:
+    """
+    Keeps a single websocket connection open per relay so that fetching and
+    publishing within one run reuse it instead of reconnecting each time.
+    Use it as `async with RelayPool() as pool:` to close every connection at the end.
+    """
+
+    def __init__(self):
+        self._conns = {}
+        self._locks = {}
+
+    async def get(self, url: str):
+        """
+        Returns the open connection to the relay, connecting on first use.
+        """
+        # The lock keeps concurrent callers from opening two connections to one relay
+        lock = self._locks.setdefault(url, asyncio.Lock())
+        async with lock:
+            websocket = self._conns.get(url)
+            # The relay may have dropped the connection while it sat idle in the pool
+            if websocket is not None and websocket.state is not State.OPEN:
+                websocket = None
+            if websocket is None:
+                websocket = await websockets.connect(
+                    url,
+                    ping_interval=20,
+                    ping_timeout=10,
+                    open_timeout=5,
+                    close_timeout=1,
+                    max_size=2**22,
+                    write_limit=2**20,
+                    # Event frames are small JSON messages; deflating them costs more than it saves
+                    compression=None,
+                )
+                self._conns[url] = websocket
+            return websocket
+
+    async def discard(self, url: str):
+        """
+        Drops the connection to the relay (e.g. after an error) so the next get() reconnects.
+        """
+        websocket = self._conns.pop(url, None)
+        if websocket is not None:
+            try:
+                await websocket.close()
+            except Exception:
+                pass
+
+    async def close(self):
+        """
+        Closes every open connection.
+        """
+        conns = list(self._conns.values())
+        self._conns.clear()
+        await asyncio.gather(*(websocket.close() for websocket in conns), return_exceptions=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()